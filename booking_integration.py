@@ -1,58 +1,73 @@
+import atexit
 import csv
+import difflib
+import os
 import re
-from datetime import datetime, time, timedelta
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import logging
+import mmap
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, so bookings there are only serialized within one process
+    fcntl = None
+
+# Time period for each hour of the day, indexed by hour
+_TIME_PERIODS = ["night"] * 5 + ["morning"] * 7 + ["afternoon"] * 5 + ["evening"] * 4 + ["night"] * 3
 
 def get_time_period(time_str: str) -> str:
     """Categorize time into morning, afternoon, evening, or night"""
-    hour = int(time_str.split(':')[0])
-    if 5 <= hour < 12:
-        return "morning"
-    elif 12 <= hour < 17:
-        return "afternoon"
-    elif 17 <= hour < 21:
-        return "evening"
-    else:
-        return "night"
+    return _TIME_PERIODS[int(time_str[:time_str.index(':')])]
 
 def filter_showtimes(showtimes: list, date_filter: str = None, time_filter: str = None) -> list:
     """Filter showtimes based on date and time preferences"""
-    filtered_shows = showtimes
-    
-    # Date filtering
+    # Resolve both filters to sets once, then check each show in a single pass
+    allowed_dates = None
     if date_filter:
-        today = datetime.now().strftime("%Y-%m-%d")
-        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-        
-        if "today" in date_filter.lower():
-            filtered_shows = [show for show in filtered_shows if show["date"] == today]
-        elif "tomorrow" in date_filter.lower():
-            filtered_shows = [show for show in filtered_shows if show["date"] == tomorrow]
+        date_filter = date_filter.lower()
+        now = datetime.now()
+        if "today" in date_filter:
+            allowed_dates = {now.strftime("%Y-%m-%d")}
+        elif "tomorrow" in date_filter:
+            allowed_dates = {(now + timedelta(days=1)).strftime("%Y-%m-%d")}
     
-    # Time filtering
+    allowed_hours = None
     if time_filter:
         time_filter = time_filter.lower()
-        if any(period in time_filter for period in ["morning", "afternoon", "evening", "night"]):
-            filtered_shows = [
-                show for show in filtered_shows 
-                if get_time_period(show["time"]) in time_filter
-            ]
+        allowed_hours = {
+            hour for hour, period in enumerate(_TIME_PERIODS)
+            if period in time_filter
+        } or None
     
-    return filtered_shows
+    if allowed_dates is None and allowed_hours is None:
+        return showtimes
+    
+    return [
+        show for show in showtimes
+        if (allowed_dates is None or show["date"] in allowed_dates)
+        and (allowed_hours is None or int(show["time"].partition(":")[0]) in allowed_hours)
+    ]
+
+# Captures theater_location, movie_name, date and time from a row with at least 10 fields
+_SHOWTIME_ROW = re.compile(r'([^,]*),[^,]*,[^,]*,[^,]*,([^,]*),[^,]*,[^,]*,([^,]*),([^,]*),')
 
 def extract_showtime_details(query_result: str) -> dict:
     """Extract showtime details from LlamaIndex query result"""
     try:
-        # Clean up the result string and split by commas
+        # Clean up the result string and pick the fields out of the row
         result = query_result.strip()
-        parts = [part.strip() for part in result.split(',')]
+        match = _SHOWTIME_ROW.match(result)
         
-        if len(parts) >= 10:
+        if match:
+            theater_location, movie_name, date, time = (field.strip() for field in match.groups())
             return {
-                'theater_location': parts[0],
-                'movie_name': parts[4],
-                'date': parts[7],
-                'time': parts[8]
+                'theater_location': theater_location,
+                'movie_name': movie_name,
+                'date': date,
+                'time': time
             }
         
         print(f"Could not parse result: {result}")
@@ -62,51 +77,269 @@ def extract_showtime_details(query_result: str) -> dict:
         print(f"Error extracting showtime details: {e}")
         return None
 
+SHOWTIMES_CSV = "Data/Showtimessampledata.csv"
+BOOKINGS_LOG = "Data/bookings.log"
+# Held while a process reads or changes seat counts, so the console, Streamlit and Telegram
+# processes can share the CSV and the bookings log
+BOOKINGS_LOCK = "Data/bookings.lock"
+
+# Read buffer for full passes over the data files, so large files take few read syscalls
+CSV_BUFFER_SIZE = 1 << 20
+
+# Fold the bookings log back into the CSV once it holds this many entries
+COMPACT_THRESHOLD = 100
+
+# _show_key(movie_name, theater_location, date, time) -> entries for the show, one per language, in file order.
+# Each entry is [row_id, seats_offset, seats_width, row, language, key], row_id being the row's position in the CSV.
+_showtime_index = None
+# Index entries by row id
+_showtime_rows = None
+# Normalized (movie names, theater names) present in the index
+_catalog_names = None
+# Row ids whose seat counts are only recorded in the bookings log
+_dirty_rows = set()
+_logged_bookings = 0
+# Bytes of the bookings log applied to the index, and the CSV's stat stamp when it was read
+_log_position = 0
+_csv_stamp = None
+# Guards the index, the bookings log and the CSV so seat checks and updates are atomic
+_booking_lock = threading.RLock()
+# Nesting depth of _locked() in the thread holding _booking_lock, and the open lock file
+_lock_depth = 0
+_lock_file = None
+
+def _normalize(value: str) -> str:
+    """Normalize a catalog or query value for comparison"""
+    return (value or "").strip().lower()
+
+def _show_key(movie_name: str, theater_location: str, date: str, time: str) -> tuple:
+    """Build the index key for a show, used both when loading and when booking"""
+    return (_normalize(movie_name), _normalize(theater_location), date.strip(), time.strip())
+
+def _build_showtime_index(csv_path: str = SHOWTIMES_CSV) -> tuple[dict, list]:
+    """Scan the showtimes CSV once, recording the byte offset of each row's seat count.
+
+    Returns (index, entries by row id).
+    """
+    index = {}
+    rows = []
+    with open(csv_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header = next(csv.reader([data.readline().decode("utf-8")]))
+        movie_col, theater_col, date_col, time_col, language_col = (
+            header.index(column)
+            for column in ("movie_name", "theater_location", "date", "time", "language")
+        )
+        offset = data.tell()
+        for line in iter(data.readline, b""):
+            record = line.rstrip(b"\r\n")
+            if record:
+                # Only quoted rows need the csv module, the rest split directly
+                if b'"' in record:
+                    row = next(csv.reader([record.decode("utf-8")]))
+                else:
+                    row = record.decode("utf-8").split(",")
+                # available_seats is the last column, so it ends where the record ends
+                seats = record.rsplit(b",", 1)[-1]
+                key = _show_key(row[movie_col], row[theater_col], row[date_col], row[time_col])
+                entry = [
+                    len(rows),
+                    offset + len(record) - len(seats),
+                    len(seats),
+                    row,
+                    _normalize(row[language_col]),
+                    key,
+                ]
+                rows.append(entry)
+                # The same show can run in several languages, so a key holds every matching row
+                index.setdefault(key, []).append(entry)
+            offset += len(line)
+    return index, rows
+
+def _find_show(index: dict, key: tuple, language: str = None) -> list:
+    """Return the entry for a show in the given language, or its first entry if no language is given"""
+    for entry in index.get(key, ()):
+        if not language or entry[4] == _normalize(language):
+            return entry
+    return None
+
+@contextmanager
+def _locked():
+    """Hold the booking lock, across processes where the OS supports it. Reentrant within a thread."""
+    global _lock_depth, _lock_file
+    with _booking_lock:
+        if _lock_depth == 0 and fcntl is not None:
+            _lock_file = open(BOOKINGS_LOCK, "a")
+            fcntl.flock(_lock_file, fcntl.LOCK_EX)
+        _lock_depth += 1
+        try:
+            yield
+        finally:
+            _lock_depth -= 1
+            if _lock_depth == 0 and _lock_file is not None:
+                # Closing the file releases the flock
+                _lock_file.close()
+                _lock_file = None
+
+def _csv_stat_stamp() -> tuple:
+    """Identify the CSV's current contents, changed by compaction or an edit in any process"""
+    stat = os.stat(SHOWTIMES_CSV)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+def _replay_bookings(index: dict, start: int = 0) -> int:
+    """Apply seat counts from the bookings log, from byte start on, on top of the index values.
+
+    Returns the log size applied up to, the end of its last complete line.
+    """
+    global _logged_bookings
+    if not os.path.exists(BOOKINGS_LOG):
+        return 0
+    with open(BOOKINGS_LOG, "rb", buffering=CSV_BUFFER_SIZE) as log:
+        log.seek(start)
+        data = log.read()
+    # A crash mid-append can leave an unterminated last line, which is not a booking yet
+    data = data[:data.rfind(b"\n") + 1]
+    for record in csv.reader(data.decode("utf-8", errors="replace").splitlines()):
+        if not record:
+            continue
+        if len(record) != 6 or not record[5].strip().isdigit():
+            logging.warning(f"Skipping malformed logged booking: {record}")
+            continue
+        movie_name, theater_location, date, time, language, _ = record
+        entry = _find_show(index, _show_key(movie_name, theater_location, date, time), language)
+        if entry is None:
+            logging.warning(f"Skipping logged booking for a show no longer in the CSV: {record}")
+            continue
+        entry[3][-1] = record[-1].strip()
+        _dirty_rows.add(entry[0])
+        _logged_bookings += 1
+    return start + len(data)
+
+def _get_showtime_index() -> dict:
+    """Return the showtime index with every process's bookings applied. Call with _locked() held.
+
+    Bookings logged by other processes since the last call are replayed. If another process
+    compacted the log into the CSV, or the CSV was edited, the index is rebuilt from disk.
+    """
+    global _showtime_index, _showtime_rows, _catalog_names, _log_position, _csv_stamp, _logged_bookings
+    log_size = os.path.getsize(BOOKINGS_LOG) if os.path.exists(BOOKINGS_LOG) else 0
+    if _showtime_index is None or _csv_stat_stamp() != _csv_stamp or log_size < _log_position:
+        _csv_stamp = _csv_stat_stamp()
+        index, _showtime_rows = _build_showtime_index()
+        _dirty_rows.clear()
+        _logged_bookings = 0
+        _log_position = _replay_bookings(index)
+        _catalog_names = ({key[0] for key in index}, {key[1] for key in index})
+        _showtime_index = index
+    elif log_size > _log_position:
+        _log_position = _replay_bookings(_showtime_index, _log_position)
+    return _showtime_index
+
+def _resolve_name(name: str, known_names: set) -> str:
+    """Map a partial or misspelled movie or theater name to the one catalog name it identifies"""
+    name = _normalize(name)
+    if name in known_names:
+        return name
+    # "INOX Lido" for "INOX Lido Indiranagar", only when a single name contains it
+    containing = [known for known in known_names if name in known]
+    if len(containing) == 1:
+        return containing[0]
+    close = difflib.get_close_matches(name, known_names, n=2, cutoff=0.85)
+    if len(close) == 1:
+        return close[0]
+    return name
+
+def _pad_seats(seats: int, width: int) -> bytes:
+    """Zero-pad a seat count to the width of its CSV field"""
+    value = str(seats).zfill(width)
+    if len(value) != width:
+        raise ValueError(f"Seat count {seats} does not fit in {width} characters")
+    return value.encode("ascii")
+
+def _log_booking(entry: list, seats: int) -> None:
+    """Record a row's new seat count in the bookings log. Call with _locked() held, after _get_showtime_index()."""
+    global _logged_bookings, _log_position
+    row_id, _, width, row, language, key = entry
+    value = _pad_seats(seats, width)
+    if os.path.exists(BOOKINGS_LOG) and os.path.getsize(BOOKINGS_LOG) > _log_position:
+        # Whatever follows the last complete line is a torn entry from a crashed append, never confirmed
+        # to its guest. Cut it off, so the log ends with a newline and the new entry starts its own line.
+        logging.warning("Dropping a partial entry at the end of the bookings log")
+        os.truncate(BOOKINGS_LOG, _log_position)
+    # Log the show rather than its row position, so edits to the CSV cannot redirect a replay
+    with open(BOOKINGS_LOG, "a", newline="") as log:
+        csv.writer(log).writerow([*key, language, seats])
+    _log_position = os.path.getsize(BOOKINGS_LOG)
+    row[-1] = value.decode("ascii")
+    _dirty_rows.add(row_id)
+    _logged_bookings += 1
+    if _logged_bookings >= COMPACT_THRESHOLD:
+        compact_bookings()
+
+def _reserve_seats(entry: list, num_tickets: int) -> tuple[bool, int]:
+    """Check and decrement a show's seats in one step, returning (booked, seats_left). Call with _locked() held."""
+    with _locked():
+        available = int(entry[3][-1])
+        if available < num_tickets:
+            return False, available
+        _log_booking(entry, available - num_tickets)
+        return True, available - num_tickets
+
+def compact_bookings() -> None:
+    """Write logged seat counts back into the CSV and clear the bookings log"""
+    global _logged_bookings, _log_position, _csv_stamp
+    with _locked():
+        if _showtime_index is None:
+            return
+        # Pick up other processes' bookings first, so their counts are written too
+        _get_showtime_index()
+        if not _dirty_rows:
+            return
+        # Seats only ever decrease, so each new count fits in its old field
+        with open(SHOWTIMES_CSV, "r+b") as file:
+            for row_id in sorted(_dirty_rows):
+                _, offset, width, row, _, _ = _showtime_rows[row_id]
+                file.seek(offset)
+                file.write(_pad_seats(int(row[-1]), width))
+            # The patched counts must be on disk before the log that backs them is cleared
+            file.flush()
+            os.fsync(file.fileno())
+        # The log holds absolute seat counts, so replaying it again after a crash here is harmless
+        open(BOOKINGS_LOG, "w").close()
+        _dirty_rows.clear()
+        _logged_bookings = 0
+        _log_position = 0
+        _csv_stamp = _csv_stat_stamp()
+
+atexit.register(compact_bookings)
+
 def book_tickets(query_result: str, num_tickets: int, movie_name: str = None, theater_name: str = None) -> tuple[bool, str]:
     try:
-        # Read directly from CSV
-        with open("Data/Showtimessampledata.csv", "r") as file:
-            reader = csv.DictReader(file)
-            showtimes = list(reader)
-        
         # Parse the query parameters from the result string
-        # Example: "2024-12-15 22:15 - hindi - 150 seats"
+        # Example: "2024-12-15 22:15 - hindi - 150 seats", the language is optional
         parts = query_result.strip().split(' - ')
-        if len(parts) >= 2:
+        if parts[0]:
             date_time = parts[0].split()
             if len(date_time) == 2:
                 date, time = date_time
-                language = parts[1]
-                
-                # Find matching showtime in CSV
-                matching_show = None
-                for show in showtimes:
-                    logging.info(f"Checking show: {show}")
-                    if (show['date'] == date and 
-                        show['time'] == time and 
-                        show['language'].lower() == language.lower() and 
-                        show['movie_name'] == movie_name and  
-                        show['theater_location'] == theater_name):  # Exact match
-                        matching_show = show
-                        logging.info(f"Found matching show: {show}")
-                        break
+                language = parts[1] if len(parts) >= 2 else None
                 
-                if matching_show:
-                    available = int(matching_show["available_seats"])
-                    if available >= num_tickets:
-                        # Update seats
-                        matching_show["available_seats"] = str(available - num_tickets)
-                        
-                        # Write back to CSV
-                        fieldnames = reader.fieldnames
-                        with open("Data/Showtimessampledata.csv", "w", newline="") as wfile:
-                            writer = csv.DictWriter(wfile, fieldnames=fieldnames)
-                            writer.writeheader()
-                            writer.writerows(showtimes)
-                        
-                        return True, f"Successfully booked {num_tickets} ticket(s)"
-                    else:
-                        return False, f"Not enough seats available. Only {available} seats left."
+                # Find matching showtime in the index, any language matches if none was given
+                with _locked():
+                    index = _get_showtime_index()
+                    movie_names, theater_names = _catalog_names
+                    entry = _find_show(index, _show_key(
+                        _resolve_name(movie_name, movie_names),
+                        _resolve_name(theater_name, theater_names),
+                        date,
+                        time
+                    ), language)
+                    if entry:
+                        logging.debug("Found matching show: %s", entry[3])
+                        booked, seats_left = _reserve_seats(entry, num_tickets)
+                        if booked:
+                            return True, f"Successfully booked {num_tickets} ticket(s)"
+                        else:
+                            return False, f"Not enough seats available. Only {seats_left} seats left."
                 
                 return False, "Could not find matching showtime in the database."
         
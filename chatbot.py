@@ -3,25 +3,40 @@ import openai
 from dotenv import load_dotenv
 from omdb_integration import fetch_movie_details
 from llama_index.llms.openai import OpenAI
-from llama_index.core import Settings, PromptTemplate
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.core import Settings, PromptTemplate, QueryBundle
 from llama_index.core.retrievers import VectorIndexRetriever
 from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.response_synthesizers import ResponseMode
 from llama_index.core.workflow import (
     StartEvent,
     StopEvent,
     Workflow,
+    Context,
     step,
     Event,
 )
 from pydantic import BaseModel
 from llama_index_builder import load_index_from_disk
+import asyncio
+import atexit
+import httpx
 import logging
-import json
+import threading
+import tiktoken
+import time
+import weakref
 from typing import Union, Optional
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache
+from itertools import chain, groupby, islice
+from operator import itemgetter
 import csv
-from booking_integration import book_tickets
+import re
+from secrets import token_hex
+from booking_integration import book_tickets, SHOWTIMES_CSV, CSV_BUFFER_SIZE
+from intent_cache import QueryCache, embed_query, normalize_query, CACHE_PATH as INTENT_CACHE_PATH
 from datetime import datetime, timedelta
-import itertools
 
 # Define welcome message
 WELCOME_MESSAGE = """
@@ -59,20 +74,33 @@ class MovieIntent(BaseModel):
     num_tickets: Optional[int] = None
     language: Optional[str] = None
 
-# Define event types
+# Define event types, each carrying the parsed intent
 class MovieReviewEvent(Event):
-    pass
+    parsed_query: MovieIntent
 
 class ShowtimesEvent(Event):
-    pass
+    parsed_query: MovieIntent
 
 class CinemaLocationEvent(Event):
-    pass
+    parsed_query: MovieIntent
 
 class BookTicketsEvent(Event):
-    pass
+    parsed_query: MovieIntent
 
 class GeneralEvent(Event):
+    parsed_query: MovieIntent
+
+# Event for each intent with its own handler step, anything else is answered from the movie index
+INTENT_EVENTS = {
+    "general": GeneralEvent,
+    "movie_review": MovieReviewEvent,
+    "showtimes": ShowtimesEvent,
+    "cinema_location": CinemaLocationEvent,
+    "book_tickets": BookTicketsEvent,
+}
+
+class ResponseChunkEvent(Event):
+    """A piece of a reply that is still being generated, carried in delta"""
     pass
 
 # Load environment variables
@@ -80,19 +108,67 @@ logging.basicConfig(level=logging.INFO)
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Initialize OpenAI LLM and index
-index = load_index_from_disk("./movie_index")
-retriever = VectorIndexRetriever(index=index, similarity_top_k=5)
-query_engine = RetrieverQueryEngine(retriever=retriever)
+# Pooled HTTP/2 connections shared by every OpenAI call, chat completions and embeddings alike
+openai_http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_keepalive_connections=20))
+
+# Intent extraction is a short structured reply, so cap it and keep it deterministic.
+# One client is shared by every turn, so its HTTP connections are reused.
+# The prompt cache key routes every intent request to servers holding the cached instruction prefix.
+llm = OpenAI(
+    model="gpt-4o-mini",
+    temperature=0,
+    max_tokens=256,
+    additional_kwargs={"seed": 42, "extra_body": {"prompt_cache_key": "movie-intent"}},
+    async_http_client=openai_http_client
+)
+# Fallback answers are free-form, so they get their own client without the intent call's cap and cache key
+answer_llm = OpenAI(model="gpt-4o-mini", async_http_client=openai_http_client)
+Settings.llm = answer_llm
+# Same default model the movie index was built with, on the shared connections
+Settings.embed_model = OpenAIEmbedding(async_http_client=openai_http_client)
+
+# Caps LLM requests in flight, so bursts of turns queue here instead of tripping OpenAI rate limits
+OPENAI_MAX_INFLIGHT = int(os.getenv("OPENAI_MAX_INFLIGHT", "20"))
+# Event loop -> its semaphore. Before Python 3.10 a semaphore binds to the loop it is created under.
+_llm_semaphores = weakref.WeakKeyDictionary()
+
+def _llm_semaphore() -> asyncio.Semaphore:
+    """Return the running loop's semaphore capping LLM requests in flight"""
+    loop = asyncio.get_running_loop()
+    semaphore = _llm_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _llm_semaphores[loop] = asyncio.Semaphore(OPENAI_MAX_INFLIGHT)
+    return semaphore
+
+# Query engine over the movie index, built once by get_query_engine()
+_query_engine = None
+_query_engine_lock = threading.Lock()
+
+def get_query_engine() -> RetrieverQueryEngine:
+    """Load the movie index on first use and build a streaming query engine over it"""
+    global _query_engine
+    with _query_engine_lock:
+        if _query_engine is None:
+            index = load_index_from_disk("./movie_index")
+            retriever = VectorIndexRetriever(index=index, similarity_top_k=5)
+            # Compact packs the retrieved chunks into as few LLM calls as fit, unlike tree_summarize's recursive calls
+            _query_engine = RetrieverQueryEngine.from_args(
+                retriever=retriever,
+                llm=answer_llm,
+                response_mode=ResponseMode.COMPACT,
+                streaming=True
+            )
+    return _query_engine
+
+# Load the index in the background at startup, so the first query that needs it does not wait on disk
+threading.Thread(target=get_query_engine, daemon=True).start()
 
 # Define the prompt template for structured prediction
+# The instructions come first and are identical on every call, so OpenAI can reuse
+# the cached prompt prefix. Only the tail after them (date, history, query) changes.
 template_str = """
 You are an AI assistant that helps with movie-related queries.
 
-Current date and time: {current_datetime}
-Chat History:
-{history}
-
 Known genres: action, thriller, comedy, drama, animation, adventure, horror, romance
 Known languages: English, Hindi, Telugu, Tamil, Kannada, Malayalam
 Known localities: Indiranagar, Koramangala, JP Nagar, Whitefield, Rajajinagar, Magrath Road
@@ -103,12 +179,12 @@ STRICT WEEKEND CALCULATION:
    - Monday to Friday: use the upcoming Saturday/Sunday
    - Saturday: use today and tomorrow
    - Sunday: use yesterday and today
-3. Example (if today is {current_datetime}):
+3. Example (if today is Thursday 2024-12-12):
    - "this weekend" -> "2024-12-14,2024-12-15" (next Saturday and Sunday)
    - NEVER use Monday as part of weekend
 
 Your task:
-- Analyze the latest user query: "{query}"
+- Analyze the latest user query, given at the end
 - Consider the previous messages in chat history for context
 - If "weekend" is mentioned, ALWAYS return Saturday,Sunday dates
 - Determine the user's intent from these options: movie_review, showtimes, cinema_location, book_tickets, general
@@ -159,12 +235,12 @@ CONTEXT HANDLING RULES:
      User: "book the 5 PM show" -> locality: "Indiranagar"
 
 Your task:
-- Analyze the latest user query: "{query}"
+- Analyze the latest user query, given at the end
 - Consider the previous messages in chat history for context
 - If booking a specific showtime that was just displayed, use the theater from the previous context
 - Determine the user's intent from these options: movie_review, showtimes, cinema_location, book_tickets, general
 
-Examples (assuming today is {current_datetime}):
+Examples (assuming today is Thursday 2024-12-12):
 1. "Telugu movies this Sunday" ->
    intent: "showtimes"
    language: "Telugu"
@@ -210,54 +286,411 @@ CRITICAL CHECKS:
 10. Booking requests MUST include "at HH:MM"
 11. When user says "this show", COPY ALL DETAILS from last shown showtime
 12. For booking context, movie_name should NEVER be null if show was just displayed
+
+Current date and time: {current_datetime}
+Chat History:
+{history}
+
+Latest user query: "{query}"
 """
 
 # Create the PromptTemplate
 prompt_template = PromptTemplate(template=template_str)
 
+# Alternate spellings of cities in the showtimes data
+CITY_ALIASES = {"bengaluru": "bangalore"}
+# The city the intent prompt fills in when a query names none
+DEFAULT_CITY = "bangalore"
+
+def _normalize_city(city: str) -> str:
+    """Lowercase a city name and map known aliases to one spelling"""
+    city = city.strip().lower()
+    return CITY_ALIASES.get(city, city)
+
+@lru_cache(maxsize=1)
+def _get_cinema_index() -> tuple[list, dict, dict]:
+    """Index the cinemas in the showtimes CSV by city and by name/address token.
+
+    Returns (cinemas, cinema ids by city, cinema ids by token). Call
+    _get_cinema_index.cache_clear() to pick up changes to the CSV.
+    """
+    cinemas = {}
+    with open(SHOWTIMES_CSV, "r", buffering=CSV_BUFFER_SIZE) as file:
+        for show in csv.DictReader(file):
+            cinemas.setdefault(show['theater_location'], {
+                'theater_location': show['theater_location'],
+                'address': show['address'],
+                'city': show['city'],
+            })
+    
+    all_cinemas = sorted(cinemas.values(), key=lambda cinema: cinema['theater_location'])
+    by_city = defaultdict(list)
+    by_token = defaultdict(set)
+    for cinema_id, cinema in enumerate(all_cinemas):
+        by_city[_normalize_city(cinema['city'])].append(cinema_id)
+        for token in f"{cinema['theater_location']} {cinema['address']}".lower().split():
+            by_token[token].add(cinema_id)
+    return all_cinemas, dict(by_city), dict(by_token)
+
+def find_cinemas(city: str = None, locality: str = None) -> list:
+    """Return the cinemas in a city whose name or address mentions every word of the locality"""
+    all_cinemas, by_city, by_token = _get_cinema_index()
+    cinema_ids = by_city.get(_normalize_city(city), []) if city else range(len(all_cinemas))
+    if locality:
+        matching = [by_token.get(token, set()) for token in locality.lower().split()]
+        if matching:
+            in_locality = set.intersection(*matching)
+            cinema_ids = [cinema_id for cinema_id in cinema_ids if cinema_id in in_locality]
+    return [all_cinemas[cinema_id] for cinema_id in cinema_ids]
+
+# How long a loaded copy of the showtimes data is reused before reading it again
+SHOWTIMES_TTL_SECONDS = 60
+
+# key -> (expires_at, value) for data loads shared across requests
+_fetch_cache = {}
+_fetch_locks = {}
+
+async def _cached_fetch(key: str, fetch, ttl: float = SHOWTIMES_TTL_SECONDS):
+    """Return the cached result of fetch(), loading it again once it is older than ttl.
+
+    Concurrent misses for the same key wait on one lock, so fetch() runs once for all of them.
+    """
+    entry = _fetch_cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    async with _fetch_locks.setdefault(key, asyncio.Lock()):
+        entry = _fetch_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        value = await asyncio.to_thread(fetch)
+        _fetch_cache[key] = (time.monotonic() + ttl, value)
+        return value
+
+def _read_showtimes() -> tuple[list, dict, dict]:
+    """Read every showtime row from the CSV, adding lowercased search columns and a sort key.
+
+    Returns (showtimes, showtimes by lowercased movie name, showtimes by date).
+    """
+    with open(SHOWTIMES_CSV, "r", buffering=CSV_BUFFER_SIZE) as file:
+        showtimes = list(csv.DictReader(file))
+    shows_by_movie = defaultdict(list)
+    shows_by_date = defaultdict(list)
+    for show in showtimes:
+        # A locality can appear in either the cinema name or its address
+        show['locality_lc'] = f"{show['theater_location']}\x00{show['address']}".lower()
+        show['theater_lc'] = show['theater_location'].lower()
+        show['genre_lc'] = show['genre'].lower()
+        show['language_lc'] = show['language'].lower()
+        hour, _, minute = show['time'].partition(':')
+        show['sort_key'] = (show['theater_location'], show['date'], int(hour), int(minute))
+    # Keep rows in display order, so sorting a filtered subset only has to merge sorted runs
+    showtimes.sort(key=itemgetter('sort_key'))
+    for show in showtimes:
+        shows_by_movie[show['movie_name'].lower()].append(show)
+        shows_by_date[show['date']].append(show)
+    return showtimes, dict(shows_by_movie), dict(shows_by_date)
+
+# Parsed intents, reused for repeated or paraphrased queries and across restarts
+intent_cache = QueryCache("intent", path=INTENT_CACHE_PATH)
+atexit.register(intent_cache.save)
+
+# Fallback answers, reused for repeated or paraphrased questions. Answers are long, so unlike
+# intents they need a closer paraphrase, and they are kept in memory only.
+ANSWER_SIMILARITY_THRESHOLD = 0.93
+MAX_CACHED_ANSWERS = 500
+answer_cache = QueryCache("answer", threshold=ANSWER_SIMILARITY_THRESHOLD, max_entries=MAX_CACHED_ANSWERS)
+
+def _last_bot_message(combined_input: str) -> str:
+    """Return the most recent bot reply in the chat history, or an empty string"""
+    _, separator, tail = combined_input.rpartition("Bot: ")
+    return tail.split("\nUser: ", 1)[0] if separator else ""
+
+_SHOW_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_SHOW_TIME = re.compile(r"(\d{1,2}):(\d{2})")
+
+def _mentions(query: str, pattern: str) -> bool:
+    """Check whether a regex pattern occurs in the query as a whole word"""
+    return re.search(rf"(?<!\w){pattern}(?!\w)", query) is not None
+
+def _slots_in_query(intent_json: str, query: str) -> bool:
+    """Check that a cached intent fits a paraphrased query: every slot it extracted is mentioned in it.
+
+    Bookings are never reused from a paraphrase, since a near-duplicate can name another show.
+    """
+    intent = MovieIntent.model_validate_json(intent_json)
+    if intent.intent == "book_tickets":
+        return False
+    query = query.lower()
+    # The default city is filled in whether or not the query names it, so it says nothing about the query
+    city = intent.city if intent.city and _normalize_city(intent.city) != DEFAULT_CITY else None
+    names = (
+        intent.movie_name,
+        intent.cinema_name,
+        city,
+        intent.locality,
+        intent.genre,
+        intent.language,
+        intent.time_context,
+    )
+    if not all(_mentions(query, re.escape(name.lower())) for name in names if name):
+        return False
+    if intent.num_tickets and not _mentions(query, str(intent.num_tickets)):
+        return False
+    if intent.showtime_str:
+        # A relative day such as "tomorrow" resolves the same way, since cached intents are keyed by today's date
+        if not intent.time_context and not all(
+            _mentions(query, date) for date in _SHOW_DATE.findall(intent.showtime_str)
+        ):
+            return False
+        # Times may be written with or without a leading zero, "09:30" or "9:30"
+        if not all(
+            _mentions(query, f"0?{int(hour)}:{minute}") for hour, minute in _SHOW_TIME.findall(intent.showtime_str)
+        ):
+            return False
+    return True
+
+# Unambiguous query shapes that are routed without asking the LLM
+_GREETING_QUERY = re.compile(r"^(?:hi|hello|hey|help|start)\b[\s!.]*$", re.I)
+_CINEMA_QUERY = re.compile(
+    r"^(?:show me |list |find |which are |what are )?(?:the |all )?(?:cinemas?|theat(?:er|re)s?|multiplex(?:es)?)"
+    r"\s+(?:in|at|near|around)\s+(?P<place>[a-z][a-z .]*?)[\s?.!]*$",
+    re.I
+)
+_REVIEW_QUERY = re.compile(
+    r"^(?:show me |give me |get me )?(?:the )?(?:reviews?|ratings?|details)\s+(?:of|for|on)\s+(?P<movie>.+?)[\s?.!]*$",
+    re.I
+)
+_SHOWTIMES_QUERY = re.compile(
+    r"^(?:show me |what are |list )?(?:the )?(?:showtimes|show ?timings|timings|shows)\s+(?:for|of)\s+(?P<movie>.+?)[\s?.!]*$",
+    re.I
+)
+# A booking that spells out every detail, such as "book 2 tickets for Moana 2 at PVR Koramangala on 2024-12-15 at 17:15"
+_BOOKING_QUERY = re.compile(
+    r"^book\s+(?P<num>\d+)\s+tickets?\s+for\s+(?P<movie>.+?)\s+at\s+(?P<cinema>.+?)\s+on\s+"
+    r"(?P<date>\d{4}-\d{2}-\d{2})(?:\s*,\s*|\s+at\s+|\s+)(?P<time>\d{1,2}:\d{2})[\s.!]*$",
+    re.I
+)
+# Words that make a showtimes query depend on dates, places or context, which the LLM resolves
+_CONTEXT_WORDS = re.compile(
+    r"\b(?:today|tonight|tomorrow|weekend|morning|afternoon|evening|night|\w+day|this|next|in|at|near|on|"
+    r"it|that|these|those|them|"
+    r"english|hindi|telugu|tamil|kannada|malayalam)\b",
+    re.I
+)
+
+# Relative days resolved with date math, offsets in days from today.
+# The weekend is the one containing or following today, the same rule the intent prompt spells out.
+_RELATIVE_DATES = {
+    "today": lambda now: [0],
+    "tonight": lambda now: [0],
+    "tomorrow": lambda now: [1],
+    "this weekend": lambda now: [5 - now.weekday(), 6 - now.weekday()],
+}
+_RELATIVE_DATE_SUFFIX = re.compile(r"^(?P<movie>.+?)\s+(?P<when>" + "|".join(_RELATIVE_DATES) + r")$", re.I)
+
+def _resolve_dates(time_context: str, now: datetime) -> Optional[list]:
+    """Return the dates a relative day such as "tomorrow" refers to, or None if it is not a known one"""
+    offsets = _RELATIVE_DATES.get(time_context.lower())
+    if offsets is None:
+        return None
+    return [(now + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in offsets(now)]
+
+# Captures that point back at the conversation or the user, such as "reviews of it" or "cinemas near me",
+# which only the LLM can resolve from the chat history
+_DEICTIC_CAPTURE = re.compile(
+    r"(?:(?:the|this|that|these|those)\s+(?:movies?|films?|shows?|ones?|places?|areas?|city)|"
+    r"it|this|that|these|those|them|one|me|us|here|there)",
+    re.I
+)
+
+def _fast_intent(query: str, shows_by_movie: dict) -> Optional[MovieIntent]:
+    """Parse queries that match a known shape exactly, or return None to use the LLM.
+
+    shows_by_movie is the loaded showtimes by lowercased title, which a showtimes query has to name.
+    """
+    if _GREETING_QUERY.match(query):
+        return MovieIntent(intent="general")
+    match = _CINEMA_QUERY.match(query)
+    if match and not _DEICTIC_CAPTURE.fullmatch(match.group("place").strip()):
+        place = match.group("place").strip()
+        if _normalize_city(place) in _get_cinema_index()[1]:
+            return MovieIntent(intent="cinema_location", city=place)
+        return MovieIntent(intent="cinema_location", locality=place)
+    match = _REVIEW_QUERY.match(query)
+    if match and not _DEICTIC_CAPTURE.fullmatch(match.group("movie").strip()):
+        return MovieIntent(intent="movie_review", movie_name=match.group("movie").strip())
+    match = _BOOKING_QUERY.match(query)
+    if match and not any(_DEICTIC_CAPTURE.fullmatch(match.group(name).strip()) for name in ("movie", "cinema")):
+        return MovieIntent(
+            intent="book_tickets",
+            movie_name=match.group("movie").strip(),
+            cinema_name=match.group("cinema").strip(),
+            # Show times in the data are zero-padded, "09:30"
+            showtime_str=f"{match.group('date')} at {match.group('time').zfill(5)}",
+            num_tickets=int(match.group("num"))
+        )
+    match = _SHOWTIMES_QUERY.match(query)
+    if match:
+        movie_name, time_context, showtime_str = match.group("movie").strip(), None, None
+        # "showtimes for Moana 2 tomorrow" only needs date math, not the LLM
+        suffix = _RELATIVE_DATE_SUFFIX.match(movie_name)
+        if suffix:
+            movie_name, time_context = suffix.group("movie"), suffix.group("when")
+            showtime_str = ",".join(_resolve_dates(time_context, datetime.now()))
+        # "showtimes for the movie" or "shows for kids" fit the shape but name no title we show
+        movie_name_lc = movie_name.lower()
+        if (not _CONTEXT_WORDS.search(movie_name) and not _DEICTIC_CAPTURE.fullmatch(movie_name)
+                and any(movie_name_lc in title for title in shows_by_movie)):
+            return MovieIntent(
+                intent="showtimes",
+                movie_name=movie_name,
+                showtime_str=showtime_str,
+                time_context=time_context
+            )
+    return None
+
+async def _retrieve(query: str) -> list:
+    """Retrieve the movie index nodes for a query, loading the index off the event loop if needed"""
+    query_engine = await asyncio.to_thread(get_query_engine)
+    # Reuse the query embedding computed for the intent cache lookup
+    embedding = await embed_query(normalize_query(query))
+    return await query_engine.aretrieve(QueryBundle(query, embedding=embedding))
+
+# Title as asked -> (OMDb details, formatted card), least recently used first
+MAX_CACHED_CARDS = 1024
+_movie_cards = OrderedDict()
+
+def _movie_card(movie_name: str, movie_details: dict) -> str:
+    """Format a movie's details, reusing the card while OMDb serves the same cached response"""
+    cached = _movie_cards.get(movie_name)
+    # A refreshed OMDb response is a new dict, so identity tells whether the card is current
+    if cached and cached[0] is movie_details:
+        _movie_cards.move_to_end(movie_name)
+        return cached[1]
+    
+    # Format core movie information
+    ratings = movie_details.get('Ratings', [])
+    response_parts = [
+        f"{movie_name.upper()} ({movie_details.get('Year', 'N/A')})"
+    ]
+    
+    # Add ratings
+    for rating in ratings:
+        if rating['Source'] == 'Internet Movie Database':
+            response_parts.append(f"IMDB: {rating['Value']}")
+        elif rating['Source'] == 'Rotten Tomatoes':
+            response_parts.append(f"Rotten Tomatoes: {rating['Value']}")
+    
+    # Add core movie details
+    response_parts.extend([
+        "",  # Empty line for spacing
+        f"Genre: {movie_details.get('Genre', 'N/A')}",
+        f"Plot: {movie_details.get('Plot', 'N/A')}",
+        f"Cast: {movie_details.get('Actors', 'N/A')}",
+        f"Director: {movie_details.get('Director', 'N/A')}"
+    ])
+    
+    card = "\n".join(response_parts)
+    _movie_cards[movie_name] = (movie_details, card)
+    _movie_cards.move_to_end(movie_name)
+    if len(_movie_cards) > MAX_CACHED_CARDS:
+        _movie_cards.popitem(last=False)
+    return card
+
+# (cache context, normalized query) -> intent parse in flight
+_intent_parses = {}
+
+async def _parse_intent(user_query: str, combined_input: str, current_datetime: str) -> MovieIntent:
+    """Return the intent cached for the query, or parse it with the LLM and cache it"""
+    # Intents depend on today's date and the last bot reply ("book this show"), so both key the cache
+    cache_context = f"{current_datetime[:10]}\n{_last_bot_message(combined_input)}"
+    cached_intent = await intent_cache.lookup(
+        user_query,
+        cache_context,
+        accept=lambda intent_json: _slots_in_query(intent_json, user_query)
+    )
+    if cached_intent:
+        return MovieIntent.model_validate_json(cached_intent)
+    
+    # Identical queries that miss at the same time share one LLM call, as the cache would share its result
+    key = (cache_context, normalize_query(user_query))
+    parse = _intent_parses.get(key)
+    if parse is None:
+        parse = asyncio.ensure_future(_predict_intent(user_query, combined_input, current_datetime, cache_context))
+        _intent_parses[key] = parse
+        parse.add_done_callback(lambda _: _intent_parses.pop(key, None))
+    # A cancelled caller leaves the parse running for the others
+    return await asyncio.shield(parse)
+
+async def _predict_intent(user_query: str, combined_input: str, current_datetime: str, cache_context: str) -> MovieIntent:
+    """Parse the query's intent with the LLM and cache it"""
+    async with _llm_semaphore():
+        parsed_query = await llm.astructured_predict(
+            MovieIntent,
+            prompt_template,
+            query=user_query,
+            history=combined_input,
+            current_datetime=current_datetime
+        )
+    await intent_cache.store(user_query, cache_context, parsed_query.model_dump_json())
+    return parsed_query
+
 class ChatbotWorkflow(Workflow):
     @step
-    async def start(self, event: StartEvent) -> Union[StopEvent, MovieReviewEvent, ShowtimesEvent, CinemaLocationEvent, BookTicketsEvent, GeneralEvent]:
+    async def start(self, ctx: Context, event: StartEvent) -> Union[StopEvent, MovieReviewEvent, ShowtimesEvent, CinemaLocationEvent, BookTicketsEvent, GeneralEvent]:
         try:
             combined_input = event.input
-            user_query = combined_input.split("\n")[-2].replace("User: ", "").strip()
+            user_query = event.question.strip()
             
             # Add logging for chat history
             logging.info("Current Chat History:")
             logging.info(combined_input)
             
-            llm = OpenAI(model="gpt-4o-mini")
-            Settings.llm = llm
-            
             current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
-            # Add logging for structured prediction
-            parsed_query = llm.structured_predict(
-                MovieIntent,
-                prompt_template,
-                query=user_query,
-                history=combined_input,
-                current_datetime=current_datetime
-            )
+            # Retrieval for a fallback answer starts now, so it overlaps the intent round trip too
+            retrieval = asyncio.create_task(_retrieve(user_query))
+            # Read the outcome of a dropped retrieval, so a failure is not reported as never retrieved
+            retrieval.add_done_callback(lambda task: task.cancelled() or task.exception())
+            try:
+                # Loading showtimes does not depend on the intent, so it overlaps the intent round trip
+                parsed_query, _ = await asyncio.gather(
+                    _parse_intent(user_query, combined_input, current_datetime),
+                    _cached_fetch("showtimes", _read_showtimes)
+                )
+            except Exception:
+                retrieval.cancel()
+                raise
             
             # Log the parsed query
             logging.info(f"Parsed Query with Context: {parsed_query.model_dump_json(indent=2)}")
             
             # Process the response based on intent
-            intent = parsed_query.intent
-            if intent == "general":
-                return GeneralEvent(input=parsed_query.model_dump_json())
-            elif intent == "movie_review":
-                return MovieReviewEvent(input=parsed_query.model_dump_json())
-            elif intent == "showtimes":
-                return ShowtimesEvent(input=parsed_query.model_dump_json())
-            elif intent == "cinema_location":
-                return CinemaLocationEvent(input=parsed_query.model_dump_json())
-            elif intent == "book_tickets":
-                return BookTicketsEvent(input=parsed_query.model_dump_json())
-            else:
-                results = query_engine.query(user_query)
-                return StopEvent(str(results))
+            event_class = INTENT_EVENTS.get(parsed_query.intent)
+            if event_class:
+                retrieval.cancel()
+                return event_class(parsed_query=parsed_query)
+            
+            # Only questions parsed to the same slots on the same day share an answer
+            answer_context = f"{current_datetime[:10]}\n{parsed_query.model_dump_json()}"
+            cached_answer = await answer_cache.lookup(user_query, answer_context)
+            if cached_answer:
+                retrieval.cancel()
+                ctx.write_event_to_stream(ResponseChunkEvent(delta=cached_answer))
+                return StopEvent(cached_answer)
+            
+            nodes = await retrieval
+            # A streamed answer holds its request open until the last token
+            async with _llm_semaphore():
+                results = await get_query_engine().asynthesize(QueryBundle(user_query), nodes)
+                # Pass tokens on as they arrive so front ends can show the answer while it is generated
+                chunks = []
+                async for token in results.async_response_gen():
+                    ctx.write_event_to_stream(ResponseChunkEvent(delta=token))
+                    chunks.append(token)
+            answer = "".join(chunks)
+            await answer_cache.store(user_query, answer_context, answer)
+            return StopEvent(answer)
                 
         except Exception as e:
             logging.error(f"Error processing query: {str(e)}")
@@ -265,100 +698,72 @@ class ChatbotWorkflow(Workflow):
 
     @step
     async def handle_movie_review(self, event: MovieReviewEvent) -> StopEvent:
-        parsed_query = json.loads(event.input)
-        movie_name = parsed_query.get("movie_name")
+        parsed_query = event.parsed_query
+        movie_name = parsed_query.movie_name
         
         if not movie_name:
             return StopEvent("Please specify a movie title for reviews or details.")
         
-        movie_details = fetch_movie_details(movie_name)
+        movie_details = await fetch_movie_details(movie_name)
         
         if movie_details.get("Response", "False") == "True":
-            # Format core movie information
-            ratings = movie_details.get('Ratings', [])
-            response_parts = [
-                f"{movie_name.upper()} ({movie_details.get('Year', 'N/A')})"
-            ]
-            
-            # Add ratings
-            for rating in ratings:
-                if rating['Source'] == 'Internet Movie Database':
-                    response_parts.append(f"IMDB: {rating['Value']}")
-                elif rating['Source'] == 'Rotten Tomatoes':
-                    response_parts.append(f"Rotten Tomatoes: {rating['Value']}")
-            
-            # Add core movie details
-            response_parts.extend([
-                "",  # Empty line for spacing
-                f"Genre: {movie_details.get('Genre', 'N/A')}",
-                f"Plot: {movie_details.get('Plot', 'N/A')}",
-                f"Cast: {movie_details.get('Actors', 'N/A')}",
-                f"Director: {movie_details.get('Director', 'N/A')}"
-            ])
-            
-            return StopEvent("\n".join(response_parts))
+            return StopEvent(_movie_card(movie_name, movie_details))
         else:
             return StopEvent(f"Sorry, I couldn't find information for '{movie_name}'.")
 
     @step
     async def handle_showtimes(self, event: ShowtimesEvent) -> StopEvent:
         try:
-            parsed_query = json.loads(event.input)
-            movie_name = parsed_query.get("movie_name")
-            locality = parsed_query.get("locality")
-            cinema_name = parsed_query.get("cinema_name")
-            showtime_str = parsed_query.get("showtime_str", "")
-            genre = parsed_query.get("genre")
-            language = parsed_query.get("language")
+            parsed_query = event.parsed_query
+            movie_name = parsed_query.movie_name
+            locality = parsed_query.locality
+            cinema_name = parsed_query.cinema_name
+            showtime_str = parsed_query.showtime_str
+            genre = parsed_query.genre
+            language = parsed_query.language
             
             logging.info(f"Processing showtimes with dates: {showtime_str}")
             
             # Read showtimes data
-            with open("Data/Showtimessampledata.csv", "r") as file:
-                csv_reader = csv.DictReader(file)
-                filtered_showtimes = list(csv_reader)
+            filtered_showtimes, shows_by_movie, shows_by_date = await _cached_fetch("showtimes", _read_showtimes)
+            target_dates = {d.strip() for d in showtime_str.split(',')} if showtime_str else None
             
             # Apply filters
             if movie_name:
-                filtered_showtimes = [s for s in filtered_showtimes 
-                                    if movie_name.lower() in s['movie_name'].lower()]
+                # Match against the distinct titles rather than every row
+                movie_name_lc = movie_name.lower()
+                filtered_showtimes = [s for title, shows in shows_by_movie.items()
+                                    if movie_name_lc in title for s in shows]
                 logging.info(f"After movie filter: {len(filtered_showtimes)} shows")
+            elif target_dates:
+                # Without a title, start from the requested dates' rows
+                filtered_showtimes = [s for date in target_dates for s in shows_by_date.get(date, ())]
+                logging.info(f"After date lookup: {len(filtered_showtimes)} shows")
             
-            if locality:
-                filtered_showtimes = [s for s in filtered_showtimes 
-                                    if locality.lower() in s['address'].lower()]
-                logging.info(f"After locality filter: {len(filtered_showtimes)} shows")
-            
-            if cinema_name:
-                filtered_showtimes = [s for s in filtered_showtimes 
-                                    if cinema_name.lower() in s['theater_location'].lower()]
-                logging.info(f"After cinema filter: {len(filtered_showtimes)} shows")
-            
-            # Add genre filtering
-            if genre:
-                filtered_showtimes = [s for s in filtered_showtimes 
-                                    if genre.lower() in s['genre'].lower()]
-                logging.info(f"After genre filter: {len(filtered_showtimes)} shows")
-            
-            # Handle date filtering for both single dates and weekend ranges
-            if showtime_str:
-                target_dates = [d.strip() for d in showtime_str.split(',')]
+            # Handle date filtering for both single dates and weekend ranges.
+            # Dates are the most selective filter and a plain string set test, so they go first
+            if target_dates and movie_name:
                 logging.info(f"Filtering for dates: {target_dates}")
                 filtered_showtimes = [s for s in filtered_showtimes 
-                                    if any(s['date'] == date for date in target_dates)]
+                                    if s['date'] in target_dates]
                 logging.info(f"After date filter: {len(filtered_showtimes)} shows")
             
-            if language:
-                filtered_showtimes = [s for s in filtered_showtimes 
-                                    if language.lower() in s['language'].lower()]
-                logging.info(f"After language filter: {len(filtered_showtimes)} shows")
+            # The remaining filters share one pass, with the short theater and language columns tested
+            # before the longer locality and genre ones
+            cinema_name_lc = cinema_name.lower() if cinema_name else None
+            language_lc = language.lower() if language else None
+            locality_lc = locality.lower() if locality else None
+            genre_lc = genre.lower() if genre else None
+            if cinema_name_lc or language_lc or locality_lc or genre_lc:
+                filtered_showtimes = [s for s in filtered_showtimes
+                                    if (not cinema_name_lc or cinema_name_lc in s['theater_lc'])
+                                    and (not language_lc or language_lc in s['language_lc'])
+                                    and (not locality_lc or locality_lc in s['locality_lc'])
+                                    and (not genre_lc or genre_lc in s['genre_lc'])]
+                logging.info(f"After cinema, language, locality and genre filters: {len(filtered_showtimes)} shows")
             
-            # Sort by theater and time
-            filtered_showtimes.sort(key=lambda x: (
-                x['theater_location'],
-                x['date'],
-                x['time']
-            ))
+            # Sort by theater and time, into a new list since the unfiltered rows are shared
+            filtered_showtimes = sorted(filtered_showtimes, key=itemgetter('sort_key'))
             
             # Format results
             formatted_results = []
@@ -386,19 +791,16 @@ class ChatbotWorkflow(Workflow):
             formatted_results.append(header)
             formatted_results.append("-" * len(header))
             
-            # Group by theater
-            current_theater = None
-            for showtime in filtered_showtimes:
-                theater = showtime['theater_location']
-                if theater != current_theater:
-                    if current_theater is not None:
-                        formatted_results.append("")
-                    formatted_results.append(f"📍 {theater} - {showtime['address']}")
-                    current_theater = theater
-                
-                formatted_results.append(
+            # Group by theater, the rows are already sorted by it
+            for index, (theater, shows) in enumerate(groupby(filtered_showtimes, key=itemgetter('theater_location'))):
+                first_show = next(shows)
+                if index:
+                    formatted_results.append("")
+                formatted_results.append(f"📍 {theater} - {first_show['address']}")
+                formatted_results.extend(
                     f" 🕒 {showtime['date']} at {showtime['time']} - "
                     f"{showtime['movie_name']} ({showtime['language']})"
+                    for showtime in chain((first_show,), shows)
                 )
             
             if len(formatted_results) <= 2:  # Only header and separator
@@ -413,35 +815,25 @@ class ChatbotWorkflow(Workflow):
     @step
     async def handle_cinema_location(self, event: CinemaLocationEvent) -> StopEvent:
         try:
-            parsed_query = json.loads(event.input)
-            locality = parsed_query.get("locality")
-            city = parsed_query.get("city")
+            parsed_query = event.parsed_query
+            locality = parsed_query.locality
+            city = parsed_query.city
             
             if not locality and not city:
                 return StopEvent("Please specify a location (city or locality) to search for cinemas.")
             
-            # Build a more specific query
-            query = f"""Find cinemas where:
-            {f"locality contains '{locality}'" if locality else ''}
-            {f"AND city contains '{city}'" if city else ''}
-            
-            Format the response as a list with:
-            - Cinema name
-            - Full address
-            - Available facilities
-            - Contact information"""
-            
-            results = query_engine.query(query)
+            cinemas = find_cinemas(city=city, locality=locality)
             
             # Format the response
-            if not str(results).strip():
+            if not cinemas:
                 return StopEvent(f"No cinemas found in {locality or city}.")
             
             formatted_results = ["🎬 Available Cinemas:", ""]
             
-            for line in str(results).strip().split('\n'):
-                if line.strip():
-                    formatted_results.append(f"📍 {line.strip()}")
+            for cinema in cinemas:
+                formatted_results.append(
+                    f"📍 {cinema['theater_location']} - {cinema['address']}, {cinema['city']}"
+                )
             
             return StopEvent("\n".join(formatted_results))
             
@@ -452,12 +844,12 @@ class ChatbotWorkflow(Workflow):
     @step
     async def handle_book_tickets(self, event: BookTicketsEvent) -> StopEvent:
         try:
-            parsed_query = json.loads(event.input)
-            movie_name = parsed_query.get("movie_name")
-            cinema_name = parsed_query.get("cinema_name")
-            showtime_str = parsed_query.get("showtime_str")
-            num_tickets = parsed_query.get("num_tickets", 1)
-            language = parsed_query.get("language")
+            parsed_query = event.parsed_query
+            movie_name = parsed_query.movie_name
+            cinema_name = parsed_query.cinema_name
+            showtime_str = parsed_query.showtime_str
+            num_tickets = parsed_query.num_tickets or 1
+            language = parsed_query.language
             
             logging.info(f"Processing booking for: {movie_name} at {cinema_name}, {showtime_str}")
             
@@ -499,60 +891,30 @@ class ChatbotWorkflow(Workflow):
                 }
                 language = language_map.get(language.lower(), language)
             
-            # Read directly from CSV
-            with open("Data/Showtimessampledata.csv", "r") as file:
-                reader = csv.DictReader(file)
-                showtimes = list(reader)
+            # book_tickets finds the show in its index, so there is no separate lookup here.
+            # It takes a file lock and can build the index or fsync a compaction, so it runs off the event loop.
+            success, message = await asyncio.to_thread(
+                book_tickets,
+                query_result=f"{date} {time} - {language}" if language else f"{date} {time}",
+                num_tickets=num_tickets,
+                movie_name=movie_name,
+                theater_name=cinema_name
+            )
             
-            # Find the exact showtime
-            matching_show = None
-            for show in showtimes:
-                # Log the comparison for debugging
-                logging.info(f"Comparing with show: {show}")
+            if success:
+                # Unguessable, since the number is all a guest shows at the theatre
+                confirmation = token_hex(4).upper()
                 
-                # Handle language comparison with None
-                language_matches = (
-                    language is None or  # If no language specified, consider it a match
-                    show['language'].lower() == language.lower()
+                return StopEvent(
+                    f"Successfully booked {num_tickets} ticket(s) for {movie_name} "
+                    f"at {cinema_name} for {showtime_str}\n\n"
+                    f"🎟️ Confirmation Number: {confirmation}\n"
+                    f"Please show this confirmation number at the theatre.\n\n"
+                    f"🍿 Enjoy your show!"
                 )
-                
-                if (show['movie_name'] == movie_name and
-                    show['theater_location'] == cinema_name and
-                    show['date'] == date and
-                    show['time'] == time and
-                    language_matches):
-                    matching_show = show
-                    logging.info(f"Found matching show: {show}")
-                    break
-            
-            if matching_show:
-                # Use the show's language if none was specified
-                show_language = language or matching_show['language']
-                
-                success, message = book_tickets(
-                    query_result=f"{date} {time} - {show_language} - {matching_show['available_seats']} seats",
-                    num_tickets=num_tickets,
-                    movie_name=movie_name,
-                    theater_name=cinema_name
-                )
-                
-                if success:
-                    import random
-                    import string
-                    confirmation = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-                    
-                    return StopEvent(
-                        f"Successfully booked {num_tickets} ticket(s) for {movie_name} "
-                        f"at {cinema_name} for {showtime_str}\n\n"
-                        f"🎟️ Confirmation Number: {confirmation}\n"
-                        f"Please show this confirmation number at the theatre.\n\n"
-                        f"🍿 Enjoy your show!"
-                    )
-                else:
-                    return StopEvent(f"Booking failed: {message}")
             else:
-                logging.warning(f"No matching showtime found for {movie_name} at {cinema_name} on {date} at {time}")
-                return StopEvent("Could not find the specified showtime. Please verify the show details and try again.")
+                logging.warning(f"Booking failed for {movie_name} at {cinema_name} on {date} at {time}: {message}")
+                return StopEvent(f"Booking failed: {message}")
             
         except Exception as e:
             logging.error(f"Error in handle_book_tickets: {str(e)}")
@@ -562,28 +924,126 @@ class ChatbotWorkflow(Workflow):
     async def handle_general(self, event: GeneralEvent) -> StopEvent:
         return StopEvent(WELCOME_MESSAGE)
 
+# Runs keep their state in a per-run context, so one workflow serves every chat
+workflow = ChatbotWorkflow()
+
+# Handler step for each intent, for queries routed without a workflow run
+INTENT_HANDLERS = {
+    "general": workflow.handle_general,
+    "movie_review": workflow.handle_movie_review,
+    "showtimes": workflow.handle_showtimes,
+    "cinema_location": workflow.handle_cinema_location,
+    "book_tickets": workflow.handle_book_tickets,
+}
+
+# Chat history sent with each intent parse is cut to this many tokens, dropping the oldest messages first
+MAX_HISTORY_TOKENS = 1500
+
+@lru_cache(maxsize=1)
+def _get_tokenizer():
+    """Return the intent model's tokenizer, or None if its encoding cannot be loaded"""
+    try:
+        return tiktoken.encoding_for_model(llm.model)
+    except Exception as e:
+        logging.warning(f"Could not load tokenizer, estimating history length instead: {e}")
+        return None
+
+# The encoding may be downloaded on first use, so it is loaded in the background too
+threading.Thread(target=_get_tokenizer, daemon=True).start()
+
+def _count_tokens(text: str) -> int:
+    """Count the tokens the intent model sees for the text"""
+    tokenizer = _get_tokenizer()
+    # About four characters per token for English text
+    return len(tokenizer.encode(text)) if tokenizer else len(text) // 4
+
+def _combine_input(question: str, history: list) -> str:
+    """Join the most recent history that fits MAX_HISTORY_TOKENS with the new question"""
+    tail = [f"User: {question}", "Bot:"]
+    budget = MAX_HISTORY_TOKENS - _count_tokens("\n".join(tail))
+    start = len(history)
+    while start > 0:
+        budget -= _count_tokens(history[start - 1]) + 1
+        if budget < 0:
+            break
+        start -= 1
+    return "\n".join(chain(islice(history, start, None), tail))
+
+async def _answer_locally(question: str) -> Optional[str]:
+    """Answer a query the fast path can route by calling its handler step directly, or return None"""
+    _, shows_by_movie, _ = await _cached_fetch("showtimes", _read_showtimes)
+    parsed_query = _fast_intent(question, shows_by_movie)
+    if parsed_query is None:
+        return None
+    logging.info(f"Intent matched without the LLM: {parsed_query.intent}")
+    result = await INTENT_HANDLERS[parsed_query.intent](INTENT_EVENTS[parsed_query.intent](parsed_query=parsed_query))
+    return result.result
+
 async def chat_with_user(question: str, history: list):
-    workflow = ChatbotWorkflow()
+    answer = await _answer_locally(question)
+    if answer is not None:
+        return answer
     # Combine history and new question
-    combined_input = "\n".join(history + [f"User: {question}", "Bot:"])
-    result = await workflow.run(input=combined_input)
+    combined_input = _combine_input(question, history)
+    result = await workflow.run(input=combined_input, question=question)
     return result.output if isinstance(result, StopEvent) else str(result)
 
+async def stream_chat_with_user(question: str, history: list):
+    """Yield the reply in pieces as it is generated, or whole if the handler builds it at once"""
+    answer = await _answer_locally(question)
+    if answer is not None:
+        yield answer
+        return
+    combined_input = _combine_input(question, history)
+    handler = workflow.run(input=combined_input, question=question)
+    streamed = False
+    async for event in handler.stream_events():
+        if isinstance(event, ResponseChunkEvent):
+            streamed = True
+            yield event.delta
+    result = await handler
+    if not streamed:
+        yield result.output if isinstance(result, StopEvent) else str(result)
+
+async def _print_reply(question: str, history: list) -> str:
+    """Print a streamed reply as it arrives and return the full text"""
+    chunks = []
+    async for chunk in stream_chat_with_user(question, history):
+        print(chunk, end="", flush=True)
+        chunks.append(chunk)
+    print()
+    return "".join(chunks)
+
+# How often the console chat writes the intent cache to disk, so a crash loses little of it
+INTENT_CACHE_SAVE_SECONDS = 300
+
+async def _save_intent_cache_periodically():
+    """Write the intent cache to disk every INTENT_CACHE_SAVE_SECONDS"""
+    while True:
+        await asyncio.sleep(INTENT_CACHE_SAVE_SECONDS)
+        await asyncio.to_thread(intent_cache.save)
+
 if __name__ == "__main__":
-    import asyncio
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    # Turns and background cache saves share one event loop on a daemon thread, so the loop keeps running
+    # while input() waits, and the shared LLM client stays on the loop that opened its connections
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(_save_intent_cache_periodically(), loop)
     print(WELCOME_MESSAGE)
     print("\nType 'quit' to exit.")
-    history = []
     MAX_HISTORY = 20  # Adjust as needed
+    # Appending past MAX_HISTORY drops the oldest message
+    history = deque(maxlen=MAX_HISTORY)
     while True:
         user_input = input("\nYou: ")
         if user_input.lower() in ["quit", "exit"]:
             break
         history.append(f"User: {user_input}")
-        if len(history) > MAX_HISTORY:
-            history = history[-MAX_HISTORY:]
-        response = asyncio.run(chat_with_user(user_input, history))
-        print(f"Bot: {response}")
+        print("Bot: ", end="", flush=True)
+        response = asyncio.run_coroutine_threadsafe(_print_reply(user_input, history), loop).result()
         history.append(f"Bot: {response}")
-        if len(history) > MAX_HISTORY:
-            history = history[-MAX_HISTORY:]
\ No newline at end of file
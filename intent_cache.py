@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+from llama_index.core import Settings
+
+# Cached intents expire after this long, relative dates are resolved against the day they were parsed
+CACHE_TTL_SECONDS = 6 * 60 * 60
+# Minimum cosine similarity for a paraphrased query to reuse a cached intent
+SIMILARITY_THRESHOLD = 0.9
+MAX_ENTRIES = 2048
+# Where the cache is saved on exit and restored from on start, as CACHE_PATH.json and CACHE_PATH.npy
+CACHE_PATH = "Data/intent_cache"
+MAX_CACHED_EMBEDDINGS = 1024
+
+logger = logging.getLogger(__name__)
+
+# Query text -> embedding task, least recently used first
+_embedding_tasks = OrderedDict()
+
+def normalize_query(query: str) -> str:
+    """Lowercase a query and collapse its whitespace"""
+    return " ".join(query.lower().split())
+
+async def embed_query(text: str) -> list:
+    """Embed a query with the configured model, sharing the result with concurrent and repeated callers.
+
+    The intent cache and the index retriever both embed each new query, so the second caller waits
+    on the first one's request instead of making its own.
+    """
+    task = _embedding_tasks.get(text)
+    if task is None or (task.done() and (task.cancelled() or task.exception())):
+        task = asyncio.ensure_future(Settings.embed_model.aget_query_embedding(text))
+        _embedding_tasks[text] = task
+        if len(_embedding_tasks) > MAX_CACHED_EMBEDDINGS:
+            _embedding_tasks.popitem(last=False)
+    else:
+        _embedding_tasks.move_to_end(text)
+    # A caller that is cancelled, such as a dropped speculative retrieval, leaves the request running for the others
+    return await asyncio.shield(task)
+
+def _write_atomically(path: str, write: Callable) -> None:
+    """Call write(file) on a temporary file beside path, then move it into place.
+
+    Each writer gets its own temporary file, so processes saving at once cannot interleave.
+    """
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", suffix=".tmp", delete=False)
+    try:
+        with file:
+            write(file)
+        os.replace(file.name, path)
+    except BaseException:
+        os.remove(file.name)
+        raise
+
+def _digest(embeddings: np.ndarray) -> str:
+    """Fingerprint an embeddings matrix, to pair it with the entries saved alongside it"""
+    return hashlib.sha256(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()).hexdigest()
+
+class QueryCache:
+    """Two-tier cache of JSON values keyed by query: exact query match first, then embedding similarity.
+
+    name says what is cached, such as "intent" or "answer", in log messages.
+    """
+
+    def __init__(self, name: str, ttl: float = CACHE_TTL_SECONDS, threshold: float = SIMILARITY_THRESHOLD, max_entries: int = MAX_ENTRIES, path: Optional[str] = None):
+        self.name = name
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self._lock = threading.Lock()
+        # (context, normalized query) -> (stored_at, value), least recently used first
+        self._exact = OrderedDict()
+        # Semantic tier: a ring buffer of unit-length query embeddings, row-aligned with
+        # (context, stored_at, value). Allocated on the first store, once the dimension is known.
+        self._embeddings = None
+        self._entries = []
+        # Rows in use, and the row the next store overwrites once the buffer is full
+        self._count = 0
+        self._next = 0
+        # Embeddings computed by a missed lookup, kept so store() does not embed the query again
+        self._pending = {}
+        if path:
+            self._load()
+
+    async def lookup(self, query: str, context: str, accept: Callable[[str], bool] = None) -> Optional[str]:
+        """Return the cached value for the query, or None on a miss.
+
+        Exact hits are returned as is. Semantic hits must also pass accept(value), so callers
+        can reject a paraphrase whose cached slots do not fit the new query.
+        """
+        normalized = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            key = (context, normalized)
+            hit = self._exact.get(key)
+            if hit and now - hit[0] < self.ttl:
+                self._exact.move_to_end(key)
+                return hit[1]
+
+        embedding = await self._embed(normalized)
+        if embedding is None:
+            return None
+        with self._lock:
+            if self._count and self._embeddings.shape[1] != embedding.shape[0]:
+                # Entries restored from disk were embedded by a different model
+                self._reset_semantic_tier()
+            if self._count:
+                scores = self._embeddings[:self._count] @ embedding
+                for row in np.argsort(scores)[::-1]:
+                    if scores[row] < self.threshold:
+                        break
+                    entry_context, stored_at, value = self._entries[row]
+                    # Only entries parsed against the same context are candidates
+                    if entry_context != context or now - stored_at >= self.ttl:
+                        continue
+                    if accept is None or accept(value):
+                        logger.info(f"Semantic {self.name} cache hit (similarity {scores[row]:.3f})")
+                        return value
+            if len(self._pending) >= self.max_entries:
+                self._pending.clear()
+            self._pending[normalized] = embedding
+        return None
+
+    async def store(self, query: str, context: str, value: str) -> None:
+        """Cache a value under its exact key and its query embedding"""
+        normalized = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            self._exact[(context, normalized)] = (now, value)
+            self._exact.move_to_end((context, normalized))
+            while len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+            embedding = self._pending.pop(normalized, None)
+
+        if embedding is None:
+            embedding = await self._embed(normalized)
+            if embedding is None:
+                return
+        with self._lock:
+            if self._embeddings is None or self._embeddings.shape[1] != embedding.shape[0]:
+                self._reset_semantic_tier(embedding.shape[0])
+            # Overwrite the oldest row in place, rather than copying the matrix to drop it
+            row = self._next
+            self._embeddings[row] = embedding
+            self._entries[row] = (context, now, value)
+            self._next = (row + 1) % self.max_entries
+            self._count = min(self._count + 1, self.max_entries)
+
+    def save(self) -> None:
+        """Write the unexpired entries to the cache path, so the next process starts warm"""
+        if not self.path:
+            return
+        with self._lock:
+            count = self._count
+            state = {
+                "exact": [[context, normalized, stored_at, value]
+                          for (context, normalized), (stored_at, value) in self._exact.items()],
+                "entries": self._entries[:count],
+            }
+            embeddings = None if self._embeddings is None else self._embeddings[:count].copy()
+        # The two files are replaced one after the other, so the JSON records which embeddings it goes with
+        state["embeddings_digest"] = None if embeddings is None else _digest(embeddings)
+        try:
+            if embeddings is not None:
+                _write_atomically(f"{self.path}.npy", lambda file: np.save(file, embeddings))
+            _write_atomically(f"{self.path}.json", lambda file: file.write(json.dumps(state).encode("utf-8")))
+        except OSError as e:
+            logger.warning(f"Could not save {self.name} cache to {self.path}: {e}")
+
+    def _load(self) -> None:
+        """Restore the unexpired entries saved by a previous process"""
+        try:
+            with open(f"{self.path}.json", "rb") as file:
+                state = json.load(file)
+            embeddings = np.load(f"{self.path}.npy", allow_pickle=False) if state["entries"] else None
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Could not load {self.name} cache from {self.path}: {e}")
+            return
+        now = time.time()
+        self._exact = OrderedDict(((context, normalized), (stored_at, value))
+                                  for context, normalized, stored_at, value in state["exact"]
+                                  if now - stored_at < self.ttl)
+        entries = [tuple(entry) for entry in state["entries"]]
+        if embeddings is not None and _digest(embeddings) != state["embeddings_digest"]:
+            # A save interrupted between the two files left embeddings from another save
+            logger.warning(f"Discarding saved {self.name} embeddings that do not match their entries")
+            entries = []
+        rows = [row for row, entry in enumerate(entries) if now - entry[1] < self.ttl]
+        # Keep the newest entries if there are more than fit
+        rows = sorted(rows, key=lambda row: entries[row][1])[-self.max_entries:]
+        if rows:
+            self._reset_semantic_tier(embeddings.shape[1])
+            count = len(rows)
+            self._embeddings[:count] = embeddings[rows]
+            self._entries[:count] = [entries[row] for row in rows]
+            self._count = count
+            self._next = count % self.max_entries
+        logger.info(f"Restored {len(self._exact)} cached {self.name}s from {self.path}")
+
+    def _reset_semantic_tier(self, dimension: Optional[int] = None) -> None:
+        """Empty the semantic tier, allocating its buffer for the given embedding dimension"""
+        self._embeddings = None if dimension is None else np.empty((self.max_entries, dimension), dtype=np.float32)
+        self._entries = [None] * self.max_entries
+        self._count = 0
+        self._next = 0
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed a normalized query as a unit vector, or None if embedding fails"""
+        try:
+            embedding = np.asarray(await embed_query(text), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Could not embed query for {self.name} cache: {e}")
+            return None
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else None
@@ -1,23 +1,123 @@
+import asyncio
 import os
-import requests
+import httpx
+import orjson
 import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from dotenv import load_dotenv
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def fetch_movie_details(title):
+load_dotenv()
+OMDB_API_KEY = os.getenv("OMDB_API_KEY")
+if not OMDB_API_KEY:
+    logger.error("OMDB_API_KEY is not set, movie details lookups will fail")
+
+# Most recently used OMDb responses, keyed by normalized title -> (expires_at, data)
+MAX_CACHED_MOVIES = 4096
+# Ratings drift slowly, so a cached response is refreshed once a day
+MOVIE_CACHE_TTL_SECONDS = 24 * 60 * 60
+_movie_cache = OrderedDict()
+_movie_cache_lock = threading.Lock()
+# Found movies are also kept on disk, so a restart does not refetch them
+MOVIE_CACHE_PATH = "Data/omdb_cache.sqlite3"
+# Serializes use of the shared SQLite connection by the worker threads that read and write it
+_db_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def _get_client() -> httpx.AsyncClient:
+    """Return a shared async HTTP client so OMDb connections are reused across calls."""
+    return httpx.AsyncClient(timeout=10)
+
+@lru_cache(maxsize=1)
+def _get_db() -> sqlite3.Connection:
+    """Open the on-disk OMDb cache, creating its table on first use."""
+    db = sqlite3.connect(MOVIE_CACHE_PATH, check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS movies (key TEXT PRIMARY KEY, expires_at REAL, data BLOB)")
+    return db
+
+def _remember(key, data, expires_at):
+    """Add a response to the in-memory cache, given its wall-clock expiry. Call with the cache lock held."""
+    _movie_cache[key] = (time.monotonic() + expires_at - time.time(), data)
+    _movie_cache.move_to_end(key)
+    if len(_movie_cache) > MAX_CACHED_MOVIES:
+        _movie_cache.popitem(last=False)
+
+def _load_from_disk(key):
+    """Return (expires_at, data) for an unexpired response saved by this or an earlier process, or None.
+
+    Blocks on disk, so it runs in a worker thread.
+    """
+    try:
+        with _db_lock:
+            row = _get_db().execute(
+                "SELECT expires_at, data FROM movies WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read OMDb cache: {e}")
+        return None
+    if row is None:
+        return None
+    return row[0], orjson.loads(row[1])
+
+def _save_to_disk(key, data, expires_at):
+    """Save a response to the on-disk cache. Blocks on disk, so it runs in a worker thread."""
+    try:
+        with _db_lock, _get_db() as db:
+            db.execute("INSERT OR REPLACE INTO movies VALUES (?, ?, ?)", (key, expires_at, orjson.dumps(data)))
+    except sqlite3.Error as e:
+        logger.warning(f"Could not write OMDb cache: {e}")
+
+def _normalize_title(title):
+    """Normalize a movie title for use as a cache key."""
+    return " ".join(title.lower().split())
+
+async def fetch_movie_details(title):
+    """Fetch detailed information about a movie, reusing cached OMDb responses."""
+    key = _normalize_title(title)
+    with _movie_cache_lock:
+        entry = _movie_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            _movie_cache.move_to_end(key)
+            return entry[1]
+    
+    # Disk I/O runs off the event loop and outside the cache lock, so other chats are not held up
+    saved = await asyncio.to_thread(_load_from_disk, key)
+    if saved is not None:
+        expires_at, data = saved
+        with _movie_cache_lock:
+            _remember(key, data, expires_at)
+        return data
+    
+    data = await _request_movie_details(title)
+    
+    # Only found movies are cached, errors such as a bad API key or a network failure are retried
+    if data.get("Response") == "True":
+        expires_at = time.time() + MOVIE_CACHE_TTL_SECONDS
+        with _movie_cache_lock:
+            _remember(key, data, expires_at)
+        await asyncio.to_thread(_save_to_disk, key, data, expires_at)
+    return data
+
+async def _request_movie_details(title):
     """Fetch detailed information about a movie from OMDb API."""
-    api_key = os.getenv("OMDB_API_KEY")
-    url = f"http://www.omdbapi.com/?t={title}&apikey={api_key}"
+    if not OMDB_API_KEY:
+        return {"Error": "OMDb API key is not configured"}
+    url = f"http://www.omdbapi.com/?t={title}&apikey={OMDB_API_KEY}"
     
     logger.info(f"Fetching movie details for: {title}")
-    logger.debug(f"OMDB API URL: {url}")
+    logger.debug("OMDB API URL: %s", url)
     
     try:
-        response = requests.get(url)
+        response = await _get_client().get(url)
         response.raise_for_status()
-        data = response.json()
-        logger.info(f"OMDB API Response for {title}: {data}")
+        data = orjson.loads(response.content)
+        logger.debug("OMDB API Response for %s: %s", title, data)
         
         # Check if movie was found
         if data.get("Response") == "False":
@@ -32,12 +132,12 @@ def fetch_movie_details(title):
         # Get IMDB rating directly
         if data.get("imdbRating") and data["imdbRating"] != "N/A":
             imdb_rating = data["imdbRating"]
-            logger.debug(f"IMDB Rating found: {imdb_rating}")
+            logger.debug("IMDB Rating found: %s", imdb_rating)
         else:
-            logger.debug(f"No IMDB Rating available. Value: {data.get('imdbRating')}")
+            logger.debug("No IMDB Rating available. Value: %s", data.get("imdbRating"))
             
         # Look through Ratings array for other sources
-        logger.debug(f"Processing Ratings array: {data.get('Ratings', [])}")
+        logger.debug("Processing Ratings array: %s", data.get("Ratings", []))
         for rating in data.get("Ratings", []):
             if rating["Source"] == "Rotten Tomatoes":
                 rotten_tomatoes = rating["Value"]
@@ -50,10 +150,13 @@ def fetch_movie_details(title):
             "RottenTomatoes": rotten_tomatoes,
             "Metacritic": metacritic
         }
-        logger.debug(f"Processed ratings: {data['ProcessedRatings']}")
+        logger.debug("Processed ratings: %s", data["ProcessedRatings"])
         
         return data
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error fetching movie details: {e}")
-        return {"Error": "Failed to connect to OMDb API"}
\ No newline at end of file
+        return {"Error": "Failed to connect to OMDb API"}
+    except orjson.JSONDecodeError as e:
+        logger.error(f"Invalid OMDb API response: {e}")
+        return {"Error": "Invalid response from OMDb API"}
\ No newline at end of file